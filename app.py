@@ -1,41 +1,311 @@
 from flask import Flask, request, jsonify
-import pdfplumber
 import os
-import openai
+import httpx
 import logging
+import asyncio
+import queue
+import threading
+import time
+import json
+import re
+import hashlib
+import tempfile
+import multiprocessing
 import fitz  # PyMuPDF
 import base64
-from PIL import Image
-from io import BytesIO
+import numpy as np
+import zstandard as zstd
+import msgpack
+import cachetools
+import redis
+import tiktoken
+from openai import AsyncOpenAI, OpenAI
+from concurrent.futures import Future, ProcessPoolExecutor
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
+from pdf_worker import extract_page_text, page_text
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-# Configure OpenAI client
-openai.api_key = os.getenv('GITHUB_API_KEY')
-openai.api_base = "https://models.inference.ai.azure.com"
+# Configure OpenAI client; pooled HTTP/2 connections are reused across requests
+OPENAI_BASE_URL = "https://models.inference.ai.azure.com"
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
 MODEL_NAME = "gpt-4o"
 
+# Token limits for the answer prompt; the text context gets whatever the
+# instructions, image descriptions, question and answer leave of the window
+MAX_CONTEXT_TOKENS = 128_000
+ANSWER_MAX_TOKENS = 150
+QUESTION_MAX_TOKENS = 4_000
+MESSAGE_OVERHEAD_TOKENS = 32
+# Conservative estimate used when the tokenizer vocabulary cannot be loaded
+FALLBACK_CHARS_PER_TOKEN = 2
+# Upper bound used to cut text before tokenizing it for clipping
+MAX_CHARS_PER_TOKEN = 8
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Create the shared OpenAI client on first use; raises if no API key is configured."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                base_url=OPENAI_BASE_URL,
+                api_key=os.getenv('GITHUB_API_KEY'),
+                http_client=httpx.Client(http2=True, limits=OPENAI_HTTP_LIMITS)
+            )
+        return _openai_client
+
+# Shared store for processed PDFs, so every worker sees every upload
+redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+# Stored PDFs expire after this long without being uploaded or asked about
+REDIS_TTL_SECONDS = int(os.getenv('REDIS_TTL_SECONDS', 7 * 24 * 60 * 60))
+
+# In-process cache of loaded PDF content, bounded by approximate size in bytes
+CONTENT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Fixed instructions that start every answer prompt
+SYSTEM_PROMPT = (
+    "You are a helpful assistant that answers questions based on the provided context, "
+    "including both text and images. Only answer based on the information given in the context."
+)
+
+# Number of images described per vision request
+IMAGE_BATCH_SIZE = 10
+
+# Image formats the model accepts, mapped to their MIME subtype
+MODEL_IMAGE_FORMATS = {'png': 'png', 'jpeg': 'jpeg', 'jpg': 'jpeg', 'gif': 'gif', 'webp': 'webp'}
+
+# Uploads are read and hashed in fixed-size chunks
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Text extraction parallelism; the process pool is shared by all request threads
+# (size it per gunicorn worker with EXTRACT_POOL_SIZE; see gunicorn.conf.py)
+PARALLEL_PAGE_THRESHOLD = 8
+MAX_EXTRACT_WORKERS = 16
+EXTRACT_POOL_SIZE = int(os.getenv('EXTRACT_POOL_SIZE', min(os.cpu_count() or 1, MAX_EXTRACT_WORKERS)))
+
+# Retrieval settings (chunk sizes are counted in tokens)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+TOP_K_CHUNKS = 5
+TOP_K_KEYWORD_CHUNKS = 8
+
+# Bump when chunking or embedding changes so cached chunks are not reused
+CHUNKER_VERSION = 2
+
+# Chat completion micro-batching
+BATCH_MAX_SIZE = 32
+BATCH_MAX_WAIT_MS = 20
+CHAT_TIMEOUT_SECONDS = 120
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
+
+def save_upload(file):
+    """Write an uploaded file to disk in one pass, returning its hash, path and bytes.
+
+    The file is written to a temporary name and renamed to <hash>.pdf, so
+    concurrent uploads never read or overwrite each other's files.
+    """
+    hasher = hashlib.blake2b()
+    buffer = bytearray()
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                hasher.update(chunk)
+                buffer.extend(chunk)
+        content_hash = hasher.hexdigest()
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{content_hash}.pdf')
+        os.replace(tmp_path, filepath)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    # Returned as-is; PyMuPDF opens a bytearray without another copy
+    return content_hash, filepath, buffer
+
+def _cache_path(content_hash):
+    return os.path.join(app.config['CACHE_FOLDER'], f'{content_hash}.v{CHUNKER_VERSION}.json.zst')
+
+def _read_cache_file(content_hash):
+    """Load and decode a cache entry; raises if it does not exist."""
+    with open(_cache_path(content_hash), 'rb') as f:
+        data = json.loads(zstd.ZstdDecompressor().decompress(f.read()))
+    if data.get('chunker_version') != CHUNKER_VERSION:
+        raise FileNotFoundError(f"Cache entry {content_hash} has an old chunker version")
+
+    embeddings = np.frombuffer(base64.b64decode(data['embeddings_b64']), dtype=np.float32)
+    if data['chunks']:
+        embeddings = embeddings.reshape(len(data['chunks']), -1)
+    return {
+        'text': data['text'],
+        'chunks': data['chunks'],
+        'embeddings': embeddings
+    }
+
+def get_cached_content(content_hash):
+    """Return cached text, chunks and embeddings for a file hash, or None."""
+    try:
+        return _read_cache_file(content_hash)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading cache entry {content_hash}: {str(e)}")
+        return None
+
+def store_cached_content(content_hash, text, chunks, embeddings):
+    """Write extracted text, chunks and embeddings to the on-disk cache."""
+    try:
+        data = json.dumps({
+            'chunker_version': CHUNKER_VERSION,
+            'text': text,
+            'chunks': chunks,
+            'embeddings_b64': base64.b64encode(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()).decode()
+        }).encode()
+        tmp_path = _cache_path(content_hash) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zstd.ZstdCompressor().compress(data))
+        os.replace(tmp_path, _cache_path(content_hash))
+    except Exception as e:
+        logger.error(f"Error writing cache entry {content_hash}: {str(e)}")
+
+def _pack(value):
+    return zstd.ZstdCompressor().compress(msgpack.packb(value))
+
+def _unpack(data):
+    return msgpack.unpackb(zstd.ZstdDecompressor().decompress(data))
+
+def store_pdf_content(filename, content_hash, content):
+    """Store processed PDF content in Redis, keyed by content hash."""
+    embeddings = content['embeddings']
+    if embeddings is not None:
+        embeddings = {'shape': list(embeddings.shape), 'data': embeddings.tobytes()}
+
+    pipe = redis_client.pipeline()
+    pipe.set(f"pdf:{content_hash}:text", zstd.ZstdCompressor().compress(content['text'].encode()), ex=REDIS_TTL_SECONDS)
+    pipe.set(f"pdf:{content_hash}:chunks", _pack(content['chunks']), ex=REDIS_TTL_SECONDS)
+    pipe.set(f"pdf:{content_hash}:embeddings", msgpack.packb(embeddings), ex=REDIS_TTL_SECONDS)
+    pipe.set(f"pdf:{content_hash}:images", _pack(content['images']), ex=REDIS_TTL_SECONDS)
+    pipe.set(f"pdf:file:{filename}", content_hash, ex=REDIS_TTL_SECONDS)
+    pipe.execute()
+
+def _refresh_pdf_content_ttl(content_hash):
+    """Extend the expiry of a document's content keys while it is in use."""
+    pipe = redis_client.pipeline(transaction=False)
+    for field in ('text', 'chunks', 'embeddings', 'images'):
+        pipe.expire(f"pdf:{content_hash}:{field}", REDIS_TTL_SECONDS)
+    pipe.execute()
+
+def load_image_descriptions(image_hashes):
+    """Return stored descriptions for image SHA-256 hashes (None where unknown)."""
+    if not image_hashes:
+        return []
+    values = redis_client.mget([f"pdf:image:{image_hash}:description:v2" for image_hash in image_hashes])
+    return [value.decode() if value is not None else None for value in values]
+
+def store_image_descriptions(descriptions):
+    """Store image descriptions keyed by image SHA-256 hash."""
+    pipe = redis_client.pipeline()
+    for image_hash, description in descriptions.items():
+        pipe.set(f"pdf:image:{image_hash}:description:v2", description, ex=REDIS_TTL_SECONDS)
+    pipe.execute()
 
-def extract_images_from_pdf(pdf_path):
+def _content_size(content):
+    """Approximate memory footprint of a loaded PDF content entry."""
+    size = len(content['text']) + sum(len(chunk) for chunk in content['chunks'])
+    if content['embeddings'] is not None:
+        size += content['embeddings'].nbytes
+    return size
+
+def _is_complete(content):
+    """True when no part of the content is missing because of an API failure at upload."""
+    if content['chunks'] and content['embeddings'] is None:
+        return False
+    return all(img['description'] for img in content['images'])
+
+_content_cache = cachetools.LRUCache(maxsize=CONTENT_CACHE_MAX_BYTES, getsizeof=_content_size)
+_content_cache_lock = threading.Lock()
+
+def load_pdf_content(filename):
+    """Load processed PDF content, or None if the file is unknown."""
+    content_hash = redis_client.getex(f"pdf:file:{filename}", ex=REDIS_TTL_SECONDS)
+    if content_hash is None:
+        return None
+
+    content_hash = content_hash.decode()
+    _refresh_pdf_content_ttl(content_hash)
+    with _content_cache_lock:
+        content = _content_cache.get(content_hash)
+    if content is not None:
+        return content
+
+    content = _load_pdf_content_from_redis(content_hash)
+    # Incomplete entries are not cached, so a later successful re-upload is seen at once
+    if content is not None and _is_complete(content):
+        try:
+            with _content_cache_lock:
+                _content_cache[content_hash] = content
+        except ValueError:
+            # Larger than the whole cache; serve it uncached
+            pass
+    return content
+
+def _load_pdf_content_from_redis(content_hash):
+    """Load and decode the Redis entries for a content hash."""
+    text, chunks, embeddings, images = redis_client.mget(
+        f"pdf:{content_hash}:text",
+        f"pdf:{content_hash}:chunks",
+        f"pdf:{content_hash}:embeddings",
+        f"pdf:{content_hash}:images"
+    )
+    if text is None:
+        return None
+
+    embeddings = msgpack.unpackb(embeddings)
+    if embeddings is not None:
+        embeddings = np.frombuffer(embeddings['data'], dtype=np.float32).reshape(embeddings['shape'])
+    return {
+        'hash': content_hash,
+        'text': zstd.ZstdDecompressor().decompress(text).decode(),
+        'chunks': _unpack(chunks),
+        'embeddings': embeddings,
+        'images': _unpack(images)
+    }
+
+def _open_pdf(pdf_path, pdf_bytes=None):
+    """Open a PDF from memory when its bytes are available, else from disk."""
+    if pdf_bytes is not None:
+        return fitz.open(stream=pdf_bytes, filetype="pdf")
+    return fitz.open(pdf_path)
+
+def extract_images_from_pdf(pdf_path, pdf_bytes=None):
     """Extract images from PDF using PyMuPDF."""
     images = []
     try:
         # Open the PDF
-        pdf_document = fitz.open(pdf_path)
+        pdf_document = _open_pdf(pdf_path, pdf_bytes)
         
         # Iterate through pages
         for page_num in range(len(pdf_document)):
@@ -51,27 +321,29 @@ def extract_images_from_pdf(pdf_path):
                     xref = img[0]
                     base_image = pdf_document.extract_image(xref)
                     image_bytes = base_image["image"]
+                    ext = base_image["ext"]
                     
-                    # Convert to PIL Image
-                    image = Image.open(BytesIO(image_bytes))
+                    # Formats the model cannot read (e.g. jpx, jbig2) are re-encoded as PNG
+                    if ext not in MODEL_IMAGE_FORMATS:
+                        pixmap = fitz.Pixmap(pdf_document, xref)
+                        if pixmap.n - pixmap.alpha >= 4:
+                            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+                        image_bytes = pixmap.tobytes("png")
+                        ext = "png"
                     
                     # Save image
-                    image_filename = f'page_{page_num + 1}_image_{img_index + 1}.png'
+                    image_filename = f'page_{page_num + 1}_image_{img_index + 1}.{ext}'
                     image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', image_filename)
-                    image.save(image_path)
-                    
-                    # Convert image to base64 for model input
-                    buffered = BytesIO()
-                    image.save(buffered, format="PNG")
-                    img_base64 = base64.b64encode(buffered.getvalue()).decode()
+                    with open(image_path, 'wb') as f:
+                        f.write(image_bytes)
                     
                     images.append({
                         'filename': image_filename,
                         'page': page_num + 1,
-                        'base64': img_base64
+                        'mime': f'image/{MODEL_IMAGE_FORMATS[ext]}',
+                        'sha256': hashlib.sha256(image_bytes).hexdigest(),
+                        'base64': base64.b64encode(image_bytes).decode()
                     })
-                    
-                    logger.debug(f"Extracted image {img_index + 1} from page {page_num + 1}")
                 except Exception as e:
                     logger.error(f"Error processing image {img_index + 1} on page {page_num + 1}: {str(e)}")
                     continue
@@ -82,141 +354,436 @@ def extract_images_from_pdf(pdf_path):
         logger.error(f"Error extracting images from PDF: {str(e)}")
         return []
 
-def extract_pdf_text(pdf_path):
-    """Extract text from PDF file using pdfplumber."""
-    if not os.path.exists(pdf_path):
+_extract_pool = None
+_extract_pool_pid = None
+_extract_pool_lock = threading.Lock()
+
+def _get_extract_pool():
+    """Return this process's shared page extraction pool, creating it on first use."""
+    global _extract_pool, _extract_pool_pid
+    with _extract_pool_lock:
+        if _extract_pool_pid != os.getpid():
+            # forkserver children start from a clean single-threaded process, so they
+            # cannot inherit locks held by request or batcher threads at fork time.
+            # They import only pdf_worker, not the whole app.
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['pdf_worker'])
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=min(EXTRACT_POOL_SIZE, MAX_EXTRACT_WORKERS),
+                mp_context=context
+            )
+            _extract_pool_pid = os.getpid()
+        return _extract_pool
+
+def _discard_extract_pool():
+    """Drop a broken pool so the next upload starts a fresh one."""
+    global _extract_pool, _extract_pool_pid
+    with _extract_pool_lock:
+        if _extract_pool is not None and _extract_pool_pid == os.getpid():
+            _extract_pool.shutdown(wait=False, cancel_futures=True)
+        _extract_pool = None
+        _extract_pool_pid = None
+
+def _extract_pages_serially(pdf_document):
+    results = []
+    for i, page in enumerate(pdf_document):
+        try:
+            results.append((i, page_text(page), None))
+        except Exception as e:
+            results.append((i, '', str(e)))
+    return results
+
+def extract_pdf_text(pdf_path, pdf_bytes=None):
+    """Extract text from PDF file using PyMuPDF, one page per worker process."""
+    if pdf_bytes is None and not os.path.exists(pdf_path):
         logger.error(f"PDF file not found: {pdf_path}")
         return None
 
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            logger.debug(f"PDF has {len(pdf.pages)} pages")
-            
-            # Extract text from each page
-            text = []
-            for i, page in enumerate(pdf.pages):
-                try:
-                    # Extract text from the page
-                    page_text = page.extract_text()
-                    if page_text:
-                        text.append(page_text)
-                        logger.debug(f"Page {i + 1} text length: {len(page_text)}")
-                        logger.debug(f"Page {i + 1} first 200 chars: {page_text[:200]}")
-                    else:
-                        logger.warning(f"No text extracted from page {i + 1}")
-                        
-                        # Try extracting words directly
-                        words = page.extract_words()
-                        if words:
-                            page_text = ' '.join(word['text'] for word in words)
-                            text.append(page_text)
-                            logger.debug(f"Extracted {len(words)} words from page {i + 1}")
-                        else:
-                            logger.warning(f"No words found on page {i + 1}")
-                            
-                            # Try extracting tables
-                            tables = page.extract_tables()
-                            if tables:
-                                table_text = []
-                                for table in tables:
-                                    table_text.extend(' '.join(str(cell) for cell in row if cell) for row in table)
-                                if table_text:
-                                    text.append('\n'.join(table_text))
-                                    logger.debug(f"Extracted {len(tables)} tables from page {i + 1}")
-                            else:
-                                logger.warning(f"No tables found on page {i + 1}")
-                except Exception as e:
-                    logger.error(f"Error extracting text from page {i + 1}: {str(e)}")
-                    continue
-            
-            # Combine all text
-            final_text = '\n'.join(text)
-            
-            if final_text.strip():
-                logger.debug(f"Total extracted text length: {len(final_text)}")
-                logger.debug(f"First 500 characters: {final_text[:500]}")
-                return final_text
+        pdf_document = _open_pdf(pdf_path, pdf_bytes)
+        page_count = pdf_document.page_count
+
+        # Small documents, or a one-process pool, gain nothing from the pool
+        if page_count < PARALLEL_PAGE_THRESHOLD or EXTRACT_POOL_SIZE < 2:
+            results = _extract_pages_serially(pdf_document)
+        else:
+            tasks = [(pdf_path, i) for i in range(page_count)]
+            try:
+                results = list(_get_extract_pool().map(extract_page_text, tasks, chunksize=4))
+            except Exception as e:
+                # Covers a broken pool as well as failing to create or start one
+                logger.error(f"Page extraction pool failed, extracting serially: {str(e)}")
+                _discard_extract_pool()
+                results = _extract_pages_serially(pdf_document)
+        pdf_document.close()
+
+        # Extract text from each page
+        text = []
+        for i, page_text, error in sorted(results):
+            if error:
+                logger.error(f"Error extracting text from page {i + 1}: {error}")
+            elif page_text.strip():
+                text.append(page_text)
             else:
-                logger.error("No text could be extracted from the PDF")
-                return None
-            
+                logger.warning(f"No text extracted from page {i + 1}")
+
+        # Combine all text
+        final_text = '\n'.join(text)
+
+        if final_text.strip():
+            logger.info("pages=%d total_chars=%d", page_count, len(final_text))
+            return final_text
+        else:
+            logger.error("No text could be extracted from the PDF")
+            return None
+
     except Exception as e:
         logger.error(f"Error processing the PDF: {str(e)}")
         return None
 
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    """Load the tokenizer on first use; returns None if its vocabulary is unavailable.
+
+    tiktoken downloads the vocabulary on first use unless TIKTOKEN_CACHE_DIR
+    points at a pre-populated cache. Without it, token counts are estimated
+    from the number of characters.
+    """
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                _encoding = tiktoken.encoding_for_model(MODEL_NAME)
+            except Exception as e:
+                logger.error(f"Could not load tokenizer, estimating tokens from characters: {str(e)}")
+            _encoding_loaded = True
+        return _encoding
+
+def count_tokens(text):
+    """Count the tokens in text (estimated if the tokenizer is unavailable)."""
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+def clip_to_tokens(text, budget):
+    """Truncate text to at most budget tokens."""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:budget * FALLBACK_CHARS_PER_TOKEN]
+
+    # Tokens rarely span more than MAX_CHARS_PER_TOKEN characters, so nothing past
+    # that point can survive the clip; cutting first avoids encoding a whole document
+    text = text[:budget * MAX_CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    if len(tokens) <= budget:
+        return text
+    return encoding.decode(tokens[:budget])
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks of chunk_size tokens."""
+    encoding = get_encoding()
+    if encoding is None:
+        # Character windows of roughly the same size
+        size = chunk_size * FALLBACK_CHARS_PER_TOKEN
+        step = (chunk_size - overlap) * FALLBACK_CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, max(len(text) - (size - step), 1), step)] if text else []
+
+    tokens = encoding.encode(text)
+    if not tokens:
+        return []
+
+    step = chunk_size - overlap
+    return [encoding.decode(tokens[i:i + chunk_size]) for i in range(0, max(len(tokens) - overlap, 1), step)]
+
+def embed_texts(texts):
+    """Embed a list of texts, returning a float32 matrix with one row per text."""
+    try:
+        vectors = []
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts[i:i + EMBEDDING_BATCH_SIZE]
+            )
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+        return np.asarray(vectors, dtype=np.float32)
+    except Exception as e:
+        logger.error(f"Error getting embeddings: {str(e)}")
+        return None
+
+def retrieve_context(question, chunks, embeddings, top_k=TOP_K_CHUNKS):
+    """Return the chunks most relevant to the question, in document order."""
+    if len(chunks) <= top_k:
+        return '\n\n'.join(chunks)
+
+    question_embedding = embed_texts([question])
+    if question_embedding is None:
+        return None
+
+    scores = embeddings @ question_embedding[0]
+    top_indices = np.sort(np.argpartition(-scores, top_k)[:top_k])
+    return '\n\n'.join(chunks[i] for i in top_indices)
+
+_chat_queue = queue.Queue()
+_chat_batcher_pid = None
+_chat_batcher_threads = ()
+_chat_batcher_loop = None
+_chat_batcher_client = None
+_chat_batcher_stop = None
+_chat_batcher_lock = threading.Lock()
+
+async def _dispatch_chat_batch(async_client, batch):
+    """Send a batch of chat completions concurrently and resolve their futures."""
+    results = await asyncio.gather(
+        *(async_client.chat.completions.create(**kwargs) for kwargs, _ in batch),
+        return_exceptions=True
+    )
+    for (_, future), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+def _collect_chat_batch():
+    """Block for the next request, then gather more until the batch is full or the window closes."""
+    batch = [_chat_queue.get()]
+    deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000
+    while len(batch) < BATCH_MAX_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_chat_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _run_chat_batcher(loop, async_client, stop):
+    """Collect queued chat requests into batches and schedule them on the event loop."""
+    while True:
+        batch = _collect_chat_batch()
+        if stop.is_set():
+            # Superseded by a restarted batcher; hand the requests over to it
+            for item in batch:
+                _chat_queue.put(item)
+            return
+        try:
+            logger.debug("Dispatching batch of %d chat requests", len(batch))
+            # Each batch runs as its own task, so collection continues while it is in flight
+            asyncio.run_coroutine_threadsafe(_dispatch_chat_batch(async_client, batch), loop)
+        except Exception as e:
+            logger.error(f"Error dispatching chat batch: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+def _run_event_loop(loop):
+    loop.run_forever()
+    loop.close()
+
+async def _shutdown_event_loop(async_client):
+    """Let in-flight batches finish, then close the client and stop the loop."""
+    current = asyncio.current_task()
+    await asyncio.gather(*(task for task in asyncio.all_tasks() if task is not current), return_exceptions=True)
+    await async_client.close()
+    asyncio.get_running_loop().stop()
+
+def _ensure_chat_batcher():
+    """Start the batcher threads once per process, restarting them if they died."""
+    global _chat_batcher_pid, _chat_batcher_threads, _chat_batcher_loop, _chat_batcher_client, _chat_batcher_stop
+    with _chat_batcher_lock:
+        if _chat_batcher_pid == os.getpid():
+            if all(thread.is_alive() for thread in _chat_batcher_threads):
+                return
+            logger.error("Chat batcher thread died; restarting it")
+
+        # Raises to the caller on failure; the next call tries again
+        async_client = AsyncOpenAI(
+            base_url=OPENAI_BASE_URL,
+            api_key=os.getenv('GITHUB_API_KEY'),
+            http_client=httpx.AsyncClient(http2=True, limits=OPENAI_HTTP_LIMITS)
+        )
+
+        # Retire the old collector and loop instead of leaving them running alongside the new ones
+        if _chat_batcher_pid == os.getpid():
+            _chat_batcher_stop.set()
+            if _chat_batcher_threads[0].is_alive():
+                asyncio.run_coroutine_threadsafe(_shutdown_event_loop(_chat_batcher_client), _chat_batcher_loop)
+        loop = asyncio.new_event_loop()
+        stop = threading.Event()
+        _chat_batcher_threads = (
+            threading.Thread(target=_run_event_loop, args=(loop,), daemon=True),
+            threading.Thread(target=_run_chat_batcher, args=(loop, async_client, stop), daemon=True)
+        )
+        for thread in _chat_batcher_threads:
+            thread.start()
+        _chat_batcher_loop = loop
+        _chat_batcher_stop = stop
+        _chat_batcher_client = async_client
+        _chat_batcher_pid = os.getpid()
+
+def submit_chat_completion(**kwargs):
+    """Queue a chat completion for the batcher and return a Future for its response."""
+    _ensure_chat_batcher()
+    future = Future()
+    _chat_queue.put((kwargs, future))
+    return future
+
+def create_chat_completion(**kwargs):
+    """Queue a chat completion for the batcher and wait for its response."""
+    return submit_chat_completion(**kwargs).result(timeout=CHAT_TIMEOUT_SECONDS)
+
+def _parse_image_descriptions(reply, count):
+    """Parse a JSON {"descriptions": [...]} reply into exactly count descriptions.
+
+    Anything that does not parse cleanly yields all None, so the images are
+    described again on the next upload instead of storing mismatched text.
+    """
+    try:
+        descriptions = json.loads(reply)['descriptions']
+    except (ValueError, TypeError, KeyError):
+        return [None] * count
+
+    if (not isinstance(descriptions, list) or len(descriptions) != count
+            or not all(isinstance(d, str) and d.strip() for d in descriptions)):
+        return [None] * count
+    return [d.strip() for d in descriptions]
+
+def describe_images(images):
+    """Describe images with one vision request per batch of images."""
+    pending = []
+    for start in range(0, len(images), IMAGE_BATCH_SIZE):
+        batch = images[start:start + IMAGE_BATCH_SIZE]
+        content = [
+            {
+                "type": "text",
+                "text": f"Describe each of the following {len(batch)} images briefly and include any visible text. "
+                        f'Reply with a JSON object {{"descriptions": [...]}} holding exactly {len(batch)} strings, '
+                        "one per image, in the order the images are given."
+            }
+        ]
+        content.extend(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{img['mime']};base64,{img['base64']}"
+                }
+            }
+            for img in batch
+        )
+        image_messages = [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that describes images accurately and concisely."
+            },
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+        
+        try:
+            future = submit_chat_completion(
+                model=MODEL_NAME,
+                messages=image_messages,
+                max_tokens=150 * len(batch),
+                response_format={"type": "json_object"}
+            )
+        except Exception as e:
+            logger.error(f"Error submitting image descriptions: {str(e)}")
+            future = None
+        pending.append((len(batch), future))
+    
+    # All batches are in flight at once; collect them in order
+    descriptions = []
+    for count, future in pending:
+        if future is None:
+            descriptions.extend([None] * count)
+            continue
+        try:
+            image_response = future.result(timeout=CHAT_TIMEOUT_SECONDS)
+            if image_response and image_response.choices:
+                reply = image_response.choices[0].message.content
+                parsed = _parse_image_descriptions(reply, count)
+                if parsed[0] is None:
+                    logger.error("Image description reply did not match the expected format")
+                descriptions.extend(parsed)
+                continue
+        except Exception as e:
+            logger.error(f"Error getting image descriptions: {str(e)}")
+        descriptions.extend([None] * count)
+    return descriptions
+
+def _keywords(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+def keyword_context(question, chunks, top_k=TOP_K_KEYWORD_CHUNKS):
+    """Return the chunks sharing the most words with the question, in document order."""
+    if len(chunks) <= top_k:
+        return '\n\n'.join(chunks)
+
+    question_words = _keywords(question)
+    scores = [len(question_words & _keywords(chunk)) for chunk in chunks]
+    if not any(scores):
+        return None
+
+    top_indices = sorted(sorted(range(len(chunks)), key=scores.__getitem__, reverse=True)[:top_k])
+    return '\n\n'.join(chunks[i] for i in top_indices)
+
 def get_answer_from_model(question, context, images=None):
-    """Get answer from GPT-4o model with image support."""
+    """Get answer from GPT-4o model using pre-computed image descriptions."""
     try:
         logger.debug("Making request to GPT-4o model")
         logger.debug(f"Context length: {len(context)} characters")
         logger.debug(f"Number of images: {len(images) if images else 0}")
         
-        # Prepare context with both text and image descriptions
-        full_context = context
+        # Build the system message as a stable prefix: fixed instructions, then the
+        # per-document image descriptions, then the (possibly per-question) text
+        context_parts = [SYSTEM_PROMPT]
         if images:
-            full_context += "\n\nThe document also contains the following images:\n"
+            context_parts.append("\n\nThe document contains the following images:\n")
             for idx, img in enumerate(images, 1):
-                full_context += f"\nImage {idx} (on page {img['page']}):\n"
-                # Get image description from model
-                try:
-                    image_messages = [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful assistant that describes images accurately and concisely."
-                        },
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{img['base64']}"
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "Describe this image briefly and include any visible text."
-                                }
-                            ]
-                        }
-                    ]
-                    
-                    image_response = openai.ChatCompletion.create(
-                        model=MODEL_NAME,
-                        messages=image_messages,
-                        max_tokens=150
-                    )
-                    
-                    if image_response and image_response.choices:
-                        img_description = image_response.choices[0].message.content
-                        full_context += f"{img_description}\n"
-                except Exception as e:
-                    logger.error(f"Error getting image description: {str(e)}")
-                    continue
+                context_parts.append(f"\nImage {idx} (on page {img['page']}):\n")
+                if img['description']:
+                    context_parts.append(f"{img['description']}\n")
+        context_parts.append("\n\nContext:\n")
         
-        logger.debug(f"First 500 characters of full context: {full_context[:500]}")
+        # Fit everything into the model window, giving the text context what is left
+        question = clip_to_tokens(question, QUESTION_MAX_TOKENS)
+        available = (MAX_CONTEXT_TOKENS - ANSWER_MAX_TOKENS - MESSAGE_OVERHEAD_TOKENS
+                     - count_tokens(question))
+        prefix = clip_to_tokens(''.join(context_parts), available)
+        budget = available - count_tokens(prefix)
+        full_context = prefix + (clip_to_tokens(context, budget) if budget > 0 else '')
         
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"First 500 characters of full context: {full_context[:500]}")
+        
+        # Only the question follows the shared prefix, so the provider can cache the rest
         messages = [
             {
                 "role": "system",
-                "content": "You are a helpful assistant that answers questions based on the provided context, including both text and images. Only answer based on the information given in the context."
+                "content": full_context
             },
             {
                 "role": "user",
-                "content": f"Context: {full_context}\n\nQuestion: {question}\n\nAnswer the question based only on the provided context."
+                "content": question
             }
         ]
         
         logger.debug("Sending request to model")
         
-        response = openai.ChatCompletion.create(
+        response = create_chat_completion(
             model=MODEL_NAME,
             messages=messages,
-            max_tokens=150,
+            max_tokens=ANSWER_MAX_TOKENS,
             temperature=0.7
         )
         
-        logger.debug(f"Response: {response}")
+        logger.debug("Response: %s", response)
         
         if response and response.choices:
             answer = response.choices[0].message.content
@@ -244,27 +811,66 @@ def upload_file():
     
     try:
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        content_hash, filepath, pdf_bytes = save_upload(file)
         
-        logger.debug(f"Processing PDF file: {filepath}")
+        logger.debug(f"Processing PDF file: {filepath} ({content_hash})")
         
-        # Extract text from PDF
-        text = extract_pdf_text(filepath)
+        cached = get_cached_content(content_hash)
+        if cached:
+            logger.debug("Using cached text and embeddings")
+            text = cached['text']
+            chunks = cached['chunks']
+            embeddings = cached['embeddings']
+        else:
+            # Extract text from PDF
+            text = extract_pdf_text(filepath, pdf_bytes)
+            
+            # Chunk and embed the text once so questions only send relevant parts
+            chunks = chunk_text(text) if text else []
+            embeddings = embed_texts(chunks) if chunks else None
+            logger.debug(f"Split text into {len(chunks)} chunks")
+            
+            if text and embeddings is not None:
+                store_cached_content(content_hash, text, chunks, embeddings)
         
         # Extract images from PDF
-        images = extract_images_from_pdf(filepath)
+        images = extract_images_from_pdf(filepath, pdf_bytes)
         logger.debug(f"Extracted {len(images)} images from PDF")
         
         if not text and not images:
             return jsonify({'error': 'Could not extract any content from PDF'}), 400
         
+        # Describe each distinct image once; descriptions are reused across uploads
+        unique_images = list({img['sha256']: img for img in images}.values())
+        descriptions = dict(zip(
+            (img['sha256'] for img in unique_images),
+            load_image_descriptions([img['sha256'] for img in unique_images])
+        ))
+        new_images = [img for img in unique_images if descriptions[img['sha256']] is None]
+        if new_images:
+            new_descriptions = {
+                img['sha256']: description
+                for img, description in zip(new_images, describe_images(new_images))
+                if description
+            }
+            store_image_descriptions(new_descriptions)
+            descriptions.update(new_descriptions)
+        images = [
+            {
+                'filename': img['filename'],
+                'page': img['page'],
+                'description': descriptions[img['sha256']]
+            }
+            for img in images
+        ]
+        
         # Store the content with the filename
-        app.pdf_contents = getattr(app, 'pdf_contents', {})
-        app.pdf_contents[filename] = {
+        store_pdf_content(filename, content_hash, {
             'text': text or '',
+            'chunks': chunks,
+            'embeddings': embeddings,
             'images': images
-        }
+        })
         
         return jsonify({
             'message': 'File uploaded successfully',
@@ -290,13 +896,12 @@ def ask_question():
     filename = data['filename']
     question = data['question']
     
-    # Check if we have the content for this file
-    if not hasattr(app, 'pdf_contents') or filename not in app.pdf_contents:
-        return jsonify({'error': 'File not found or not processed'}), 404
-    
     try:
-        # Get the content
-        content = app.pdf_contents[filename]
+        # Check if we have the content for this file
+        content = load_pdf_content(filename)
+        if content is None:
+            return jsonify({'error': 'File not found or not processed'}), 404
+        
         text = content['text']
         images = content['images']
         
@@ -305,7 +910,16 @@ def ask_question():
         logger.debug(f"Text length: {len(text)} characters")
         logger.debug(f"Number of images: {len(images)}")
         
-        answer = get_answer_from_model(question, text, images)
+        # Only send the most relevant chunks; fall back to a keyword screen, then the full text
+        context = None
+        if content['embeddings'] is not None:
+            context = retrieve_context(question, content['chunks'], content['embeddings'])
+        if context is None and content['chunks']:
+            context = keyword_context(question, content['chunks'])
+        if context is None:
+            context = text
+        
+        answer = get_answer_from_model(question, context, images)
         
         if answer:
             return jsonify({
@@ -323,4 +937,5 @@ def ask_question():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; use gunicorn (see gunicorn.conf.py) in production
+    app.run(debug=bool(os.getenv('FLASK_DEV')))
@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# Run with: gunicorn wsgi:app
+bind = '0.0.0.0:8000'
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 4
+
+# Import app (fitz, openai, numpy) once in the master and share it with the workers
+preload_app = True
+
+# Every worker has its own page extraction pool; split the CPUs between them so
+# the host runs about cpu_count extraction processes rather than cpu_count squared.
+# With one process per worker, pages are extracted in the request thread instead.
+os.environ.setdefault('EXTRACT_POOL_SIZE', str(max(1, multiprocessing.cpu_count() // workers)))
@@ -0,0 +1,24 @@
+"""Per-page text extraction for the worker pool.
+
+Pool processes import only this module, so keep its imports to PyMuPDF.
+"""
+import fitz  # PyMuPDF
+
+def page_text(page):
+    """Extract the text of a single page, falling back to text blocks."""
+    text = page.get_text("text")
+    if not text.strip():
+        # Fall back to block extraction for unusual layouts
+        text = '\n'.join(block[4] for block in page.get_text("blocks"))
+    return text
+
+def extract_page_text(args):
+    """Extract text from a single PDF page (runs in a worker process)."""
+    pdf_path, page_num = args
+    try:
+        pdf_document = fitz.open(pdf_path)
+        text = page_text(pdf_document[page_num])
+        pdf_document.close()
+        return page_num, text, None
+    except Exception as e:
+        return page_num, '', str(e)